@@ -14,6 +14,14 @@ options:
     description:
       - Grid Infrastructure home, can be absent if ORACLE_HOME environment variable is set
     required: false
+  use_cache:
+    description:
+      - Return facts collected by a previous run on the same host if they are younger than 60 seconds
+      - Facts are cached in /dev/shm, one file per effective user and I(oracle_home)
+      - Changes made to listeners, SCANs, VIPs or databases within that time are not reflected,
+        set to false when calling the module again after such a change
+    type: bool
+    default: true
 notes:
   - Oracle Grid Infrastructure 12cR1 or later required
   - Must be run as (become) GI owner
@@ -32,25 +40,127 @@ EXAMPLES = '''
   debug: var=_oracle_gi_facts
 '''
 
+import hashlib
+import json
+import os
+import re
+import shlex
+import shutil
 import socket
+import stat
+import tempfile
+import time
+from functools import lru_cache
 from subprocess import check_output, CalledProcessError, TimeoutExpired
 
+_RE_LISTENER_NAME = re.compile('Listener (.+) is enabled')
+_RE_SCAN_NAME = re.compile('SCAN name: (.+), Network: ([0-9]+)')
+_RE_SCAN_VIP = re.compile('SCAN [0-9]+ (IPv[46]) VIP: (.+)')
+# 19c "Endpoints: ..." or 18c, 12c "SCAN Listener ... exists. Port: ..."
+_RE_SCAN_ENDPOINTS = re.compile(r'Endpoints: (?P<endpoints>.+)|SCAN Listener .+ exists\. Port: (?P<port>.+)')
+_RE_VERSION = re.compile(r'\[([0-9.]+)\]$')
+
+# srvctl output "Key: value" lines, mapped onto fact names
+_LISTENER_FIELDS = {'Type': 'type'}
+_NETWORK_FIELDS = {'Subnet IPv4': 'ipv4', 'Subnet IPv6': 'ipv6'}
+_ASM_FIELDS = {'ASM home': 'asm_home',
+               'Password file': 'pwfile',
+               'ASM listener': 'listener',
+               'Spfile': 'spfile',
+               'ASM diskgroup discovery string': 'diskgroup'}
+_VIP_FIELDS = {'VIP IPv4 Address': 'ipv4', 'VIP IPv6 Address': 'ipv6'}
+
+_CACHE_TTL = 60
+_HAS_VERSIONS = ['releaseversion', 'releasepatch', 'softwareversion', 'softwarepatch']
+
+
+def _read_section(path):
+    """Return stripped output lines saved by exec_sections(), None if the command failed or did not finish"""
+    try:
+        with open(path, 'rb') as f:
+            output = f.read()
+    except (IOError, OSError):
+        return None
+    return [line.strip() for line in output.decode('utf-8', errors='replace').splitlines()]
+
+
+def exec_sections(commands, env=None, timeout=30, kill_after=5, max_jobs=8):
+    """Run list of (tag, arguments) commands in a single shell, at most max_jobs of them concurrently.
 
-def exec_program_lines(arguments):
+    Returns dict of output lines keyed by tag. Output of a command which fails or times out is discarded,
+    each command is killed kill_after seconds after its timeout expired.
+    """
+    if not commands:
+        return dict()
+    d = tempfile.mkdtemp(prefix='oracle_gi_facts.')
+    # Each command writes into its own file, so their startup latencies overlap and a hung command only
+    # loses its own output. The file is renamed into place only if the command succeeded.
+    script = []
+    for i, (tag, arguments) in enumerate(commands):
+        # wait -n needs bash 4.3, older bash polls
+        script.append('while [ "$(jobs -rp | wc -l)" -ge %d ]; do wait -n 2>/dev/null || sleep 0.1; done'
+                      % max_jobs)
+        script.append('{ timeout -k %d %d %s > "$1/%d.tmp" && mv "$1/%d.tmp" "$1/%d"; } &'
+                      % (kill_after, timeout, ' '.join(shlex.quote(a) for a in arguments), i, i, i))
+    script.append('wait')
+    waves = (len(commands) + max_jobs - 1) // max_jobs
     try:
-        output = check_output(arguments, timeout=30)
-        return [line.strip().decode() for line in output.splitlines()]
+        # close_fds=False skips closing every inherited descriptor up to RLIMIT_NOFILE in the child
+        check_output(['bash', '-c', '\n'.join(script), 'bash', d], timeout=waves * (timeout + kill_after) + 5,
+                     close_fds=False, env=env)
     except CalledProcessError:
         # Just ignore the error
-        return ['']
+        pass
     except TimeoutExpired:
-        return ['']
+        pass
+    sections = dict()
+    try:
+        for i, (tag, _) in enumerate(commands):
+            lines = _read_section(os.path.join(d, str(i)))
+            if lines is not None:
+                sections[tag] = lines
+    finally:
+        shutil.rmtree(d, ignore_errors=True)
+    return sections
+
+
+def cache_path(oracle_home=None):
+    name = 'oracle_gi_facts.%d' % os.geteuid()
+    if oracle_home:
+        name += '.' + hashlib.sha1(oracle_home.encode()).hexdigest()[:12]
+    return os.path.join('/dev/shm', name + '.json')
+
+
+def load_cached_facts(path, ttl=_CACHE_TTL):
+    """Return facts saved by a previous run, None if missing, stale or not owned by us"""
+    try:
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or time.time() - st.st_mtime >= ttl:
+            return None
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
 
 
-def exec_program(arguments):
-    return exec_program_lines(arguments)[0]
+def save_cached_facts(path, facts):
+    """Atomically replace facts cache, errors are ignored"""
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=os.path.basename(path) + '.')
+    except OSError:
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(facts, f)
+        os.replace(tmp, path)
+    except OSError:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
 
 
+@lru_cache(maxsize=256)
 def hostname_to_fqdn(hostname):
     if "." not in hostname:
         return socket.getfqdn(hostname)
@@ -64,38 +174,96 @@ class OracleGiFacts:
         self.ohomes = ohomes
         self.networks = dict()
         self.vips = dict()
+        self.scans = dict()
+        self.sections = dict()
         self.srvctl = os.path.join(ohomes.crs_home, 'bin', 'srvctl')
+        self.crsctl = ohomes.crsctl or os.path.join(ohomes.crs_home, 'bin', 'crsctl')
         self.cemutlo = os.path.join(ohomes.crs_home, 'bin', 'cemutlo')
         self.shorthostname = socket.gethostname().split('.', 1)[0]
+        # Fixed argv prefixes, only the trailing arguments vary between calls
+        self.srvctl_config = [self.srvctl, 'config']
+        self.crsctl_query = [self.crsctl, 'query']
+        # Environment shared by all calls, the fixed locale keeps srvctl messages parsable
+        self.env = {'ORACLE_HOME': ohomes.crs_home,
+                    'LD_LIBRARY_PATH': os.path.join(ohomes.crs_home, 'lib'),
+                    'PATH': ':'.join([os.path.join(ohomes.crs_home, 'bin'), '/usr/bin', '/bin']),
+                    'NLS_LANG': 'AMERICAN_AMERICA.AL32UTF8',
+                    'LANG': 'C'}
+        for var in ['ORACLE_BASE', 'HOME', 'USER', 'LOGNAME', 'TMPDIR']:
+            if var in os.environ:
+                self.env[var] = os.environ[var]
 
-    def local_listener(self):
-        args = [self.srvctl, 'status', 'listener']
+    def section(self, tag):
+        return self.sections.get(tag, [])
+
+    def section_line(self, tag):
+        lines = self.section(tag)
+        return lines[0] if lines else ''
+
+    def fetch(self):
+        """Execute all independent srvctl/crsctl calls in a single shell, returns True if all of them succeeded"""
+        status_listener = [self.srvctl, 'status', 'listener']
+        # CRS vs. Oracle Restart is read from local_only in /etc/oracle/ocr.loc, no need to fork olsnodes
+        if self.ohomes.oracle_crs:
+            status_listener += ['-n', self.shorthostname]
+        commands = [('clustername', [self.cemutlo, '-n']),
+                    ('asm', self.srvctl_config + ['asm']),
+                    ('vip', self.srvctl_config + ['vip', '-n', self.shorthostname]),
+                    ('network', self.srvctl_config + ['network']),
+                    ('scan', self.srvctl_config + ['scan', '-all']),
+                    ('status_listener', status_listener),
+                    ('listener', self.srvctl_config + ['listener']),
+                    ('database', self.srvctl_config + ['database'])]
         if self.ohomes.oracle_crs:
-            args += ['-n', self.shorthostname]
-        listeners_out = exec_program_lines(args)
-        re_listener_name = re.compile('Listener (.+) is enabled')
+            commands.append(('activeversion', self.crsctl_query + ['crs', 'activeversion']))
+        else:
+            # crsctl answers one query per call, the four version queries share this shell
+            commands += [(i, self.crsctl_query + ['has', i]) for i in _HAS_VERSIONS]
+        sections = exec_sections(commands, self.env)
+        self.sections.update(sections)
+        return len(sections) == len(commands)
+
+    def fetch_scan_listeners(self):
+        """Execute srvctl calls which depend on SCANs in a single shell, only networks with a SCAN are probed.
+
+        Returns True if all of them succeeded.
+        """
+        commands = []
+        if self.ohomes.oracle_crs:
+            commands += [('scan_listener:' + n, self.srvctl_config + ['scan_listener', '-k', n])
+                         for n in self.scans]
+        sections = exec_sections(commands, self.env)
+        self.sections.update(sections)
+        return len(sections) == len(commands)
+
+    def local_listener(self):
         listeners = []
-        out = []
-        for line in listeners_out:
+        for line in self.section('status_listener'):
             if "is enabled" in line:
-                m = re_listener_name.search(line)
+                m = _RE_LISTENER_NAME.search(line)
                 listeners.append(m.group(1))
+        # "srvctl config listener" lists all listeners, each one starting with its Name: line
+        configs = dict()
+        config = {}
+        for line in self.section('listener'):
+            key, _, value = line.partition(':')
+            value = value.strip()
+            if key == 'Name':
+                config = {'name': value}
+                configs[value] = config
+            elif key in _LISTENER_FIELDS:
+                config[_LISTENER_FIELDS[key]] = value
+            elif key == 'Network':
+                config['network'] = value.partition(',')[0]
+            elif key == 'End points':
+                config['endpoints'] = value
+                for proto in config['endpoints'].split('/'):
+                    p = proto.split(':')
+                    config[p[0].lower()] = p[1]
+        out = []
         for l in listeners:
-            config = {}
-            output = exec_program_lines([self.srvctl, 'config', 'listener', '-l', l])
-            for line in output:
-                if line.startswith('Name:'):
-                    config['name'] = line[6:]
-                elif line.startswith('Type:'):
-                    config['type'] = line[6:]
-                elif line.startswith('Network:'):
-                    config['network'] = line[9:line.find(',')]
-                elif line.startswith('End points:'):
-                    config['endpoints'] = line[12:]
-                    for proto in config['endpoints'].split('/'):
-                        p = proto.split(':')
-                        config[p[0].lower()] = p[1]
-            if "network" in config.keys():
+            config = configs.get(l, {})
+            if "network" in config and config['network'] in self.vips:
                 config['address'] = self.vips[config['network']]['fqdn']
                 config['ipv4'] = self.vips[config['network']]['ipv4']
                 config['ipv6'] = self.vips[config['network']]['ipv6']
@@ -104,20 +272,12 @@ class OracleGiFacts:
 
     def scan_listener(self):
         out = dict()
-        for n in self.networks.keys():
-            output = exec_program_lines([self.srvctl, 'config', 'scan_listener', '-k', n])
+        for n in self.scans:
+            output = self.section('scan_listener:' + n)
             for line in output:
-                endpoints = None
-                # 19c
-                m = re.search('Endpoints: (.+)', line)
+                m = _RE_SCAN_ENDPOINTS.search(line)
                 if m is not None:
-                    endpoints = m.group(1)
-                else:
-                    # 18c, 12c
-                    m = re.search('SCAN Listener (.+) exists. Port: (.+)', line)
-                    if m is not None:
-                        endpoints = m.group(2)
-                if endpoints:
+                    endpoints = m.group('endpoints') or m.group('port')
                     out[n] = dict(network=n
                                   , scan_address=self.scans[n]['fqdn']
                                   , endpoints=endpoints
@@ -132,84 +292,74 @@ class OracleGiFacts:
     def get_networks(self):
         out = dict()
         item = dict()
-        output = exec_program_lines([self.srvctl, 'config', 'network'])
+        output = self.section('network')
         for line in output:
-            m = re.search('Network ([0-9]+) exists', line)
-            if m is not None:
-                if "network" in item.keys():
-                    out[item['network']] = item
-                item = {'network': m.group(1)}
-            elif line.startswith('Subnet IPv4:'):
-                item['ipv4'] = line[13:]
-            elif line.startswith('Subnet IPv6:'):
-                item['ipv6'] = line[13:]
-        if "network" in item.keys():
+            if line.startswith('Network ') and line.endswith(' exists'):
+                # Network 1 exists
+                network = line[len('Network '):-len(' exists')]
+                if network.isdigit():
+                    if "network" in item:
+                        out[item['network']] = item
+                    item = {'network': network}
+            else:
+                key, _, value = line.partition(':')
+                if key in _NETWORK_FIELDS:
+                    item[_NETWORK_FIELDS[key]] = value.strip()
+        if "network" in item:
             out[item['network']] = item
+        self.networks = out
         return out
 
     def get_asm(self):
-        output = exec_program_lines([self.srvctl, 'config', 'asm'])
+        output = self.section('asm')
         out = dict()
         for line in output:
-            try:
-                value = line.split(': ')[1]
-            except IndexError:
-                value = ''
-            if line.startswith('ASM home'):
-                out.update({'asm_home': value})
-            elif line.startswith('Password file'):
-                out.update({'pwfile': value})
-            elif line.startswith('ASM listener'):
-                out.update({'listener': value})
-            elif line.startswith('Spfile'):
-                out.update({'spfile': value})
-            elif line.startswith('ASM diskgroup discovery string'):
-                out.update({'diskgroup': value})
+            key, _, value = line.partition(':')
+            if key in _ASM_FIELDS:
+                out[_ASM_FIELDS[key]] = value.strip()
         return out
 
     def get_vips(self):
-        output = exec_program_lines([self.srvctl, 'config', 'vip', '-n', self.shorthostname])
+        output = self.section('vip')
         vip = dict()
         out = dict()
         for line in output:
-            try:
-                value = line.split(': ')[1]
-            except IndexError:
-                value = ''
-            if line.startswith('VIP exists:'):
-                if "network" in vip.keys():
+            key, _, value = line.partition(':')
+            value = value.strip()
+            if key in _VIP_FIELDS:
+                vip[_VIP_FIELDS[key]] = value
+            elif key == 'VIP exists':
+                if "network" in vip:
                     out[vip['network']] = vip
                 vip = {}
-                m = re.search('network number ([0-9]+),', line)
-                vip['network'] = m.group(1)
-            elif line.startswith('VIP Name:'):
+                # VIP exists: network number 1, hosttype LOCAL
+                vip['network'] = value.partition('network number ')[2].partition(',')[0]
+            elif key == 'VIP Name':
                 vip['name'] = value
                 vip['fqdn'] = hostname_to_fqdn(vip['name'])
-            elif line.startswith('VIP IPv4 Address:'):
-                vip['ipv4'] = value
-            elif line.startswith('VIP IPv6 Address:'):
-                vip['ipv6'] = value
-        if "network" in vip.keys():
+        if "network" in vip:
             out[vip['network']] = vip
+        self.vips = out
         return out
 
     def get_scans(self):
         out = dict()
         item = dict()
-        output = exec_program_lines([self.srvctl, 'config', 'scan', '-all'])
+        output = self.section('scan')
         for line in output:
-            if line.startswith('SCAN name:'):
-                if "network" in item.keys():
+            if line.partition(':')[0] == 'SCAN name':
+                if "network" in item:
                     out[item['network']] = item
-                m = re.search('SCAN name: (.+), Network: ([0-9]+)', line)
+                m = _RE_SCAN_NAME.search(line)
                 item = {'network': m.group(2), 'name': m.group(1), 'ipv4': [], 'ipv6': []}
                 item['fqdn'] = hostname_to_fqdn(item['name'])
             else:
-                m = re.search('SCAN [0-9]+ (IPv[46]) VIP: (.+)', line)
+                m = _RE_SCAN_VIP.search(line)
                 if m is not None:
                     item[m.group(1).lower()] += [m.group(2)]
-        if "network" in item.keys():
+        if "network" in item:
             out[item['network']] = item
+        self.scans = out
         return out
 
 
@@ -217,11 +367,16 @@ class OracleGiFacts:
 def main():
     module = AnsibleModule(
         argument_spec=dict(
-            oracle_home=dict(required=False, aliases=['oh'])
+            oracle_home=dict(required=False, aliases=['oh']),
+            use_cache=dict(default=True, required=False, type='bool')
         ),
         supports_check_mode=True
     )
     # Preparation
+    if module.params["use_cache"]:
+        facts = load_cached_facts(cache_path(module.params["oracle_home"]))
+        if facts is not None:
+            module.exit_json(msg=" ", changed=False, ansible_facts={"oracle_gi_facts": facts})
     facts = {}
     if module.params["oracle_home"]:
         os.environ['ORACLE_HOME'] = module.params["oracle_home"]
@@ -237,44 +392,48 @@ def main():
 
     os.environ['ORACLE_HOME'] = ohomes.crs_home
     oracle_gi_facts = OracleGiFacts(module, ohomes)
+    fetched = oracle_gi_facts.fetch()
 
     # Cluster name
-    facts.update({'clustername': exec_program([oracle_gi_facts.cemutlo, '-n'])})
+    facts['clustername'] = oracle_gi_facts.section_line('clustername')
 
     # Cluster version
     if ohomes.oracle_crs:
-        version = exec_program([ohomes.crsctl, 'query', 'crs', 'activeversion'])
-        facts.update({'activeversion': version})
+        version = oracle_gi_facts.section_line('activeversion')
+        facts['activeversion'] = version
     else:
-        for i in ['releaseversion', 'releasepatch', 'softwareversion', 'softwarepatch']:
-            version = exec_program([ohomes.crsctl, 'query', 'has', i])
-            m = re.search('\[([0-9\.]+)\]$', version)
+        for i in _HAS_VERSIONS:
+            version = oracle_gi_facts.section_line(i)
+            m = _RE_VERSION.search(version)
             if m:
-                facts.update({i: m.group(1)})
-                facts.update({"version": m.group(1)})  # for backward compatibility
+                facts[i] = m.group(1)
+                facts['version'] = m.group(1)  # for backward compatibility
             else:
-                facts.update({i: version})
+                facts[i] = version
 
     # ASM
     asm = oracle_gi_facts.get_asm()
-    facts.update({'asm': asm})
+    facts['asm'] = asm
     # VIPS
     vips = oracle_gi_facts.get_vips()
-    facts.update({'vip': list(vips.values())})
+    facts['vip'] = list(vips.values())
     # Networks
     networks = oracle_gi_facts.get_networks()
-    facts.update({'network': list(networks.values())})
+    facts['network'] = list(networks.values())
     # SCANs
     scans = oracle_gi_facts.get_scans()
-    facts.update({'scan': list(scans.values())})
+    facts['scan'] = list(scans.values())
     # Listener
-    facts.update({'local_listener': oracle_gi_facts.local_listener()})
-    facts.update({'scan_listener': list(oracle_gi_facts.scan_listener().values()) if ohomes.oracle_crs else []})
+    fetched = oracle_gi_facts.fetch_scan_listeners() and fetched
+    facts['local_listener'] = oracle_gi_facts.local_listener()
+    facts['scan_listener'] = list(oracle_gi_facts.scan_listener().values()) if ohomes.oracle_crs else []
     # Databases
-    facts.update({'database_list': exec_program_lines([oracle_gi_facts.srvctl, 'config', 'database'])})
+    facts['database_list'] = oracle_gi_facts.section('database')
     # ORACLE_CRS_HOME
-    facts.update({'oracle_crs_home': os.environ['ORACLE_HOME']})
+    facts['oracle_crs_home'] = os.environ['ORACLE_HOME']
     # Output
+    if module.params["use_cache"] and fetched:
+        save_cached_facts(cache_path(module.params["oracle_home"]), facts)
     module.exit_json(msg=" ", changed=False, ansible_facts={"oracle_gi_facts": facts})
 
 